@@ -1,10 +1,25 @@
 import os
 import csv
+import json
+import queue
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import islice
+from datetime import datetime, timedelta, timezone
 import re
+import sys
+import threading
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    _loads = json.loads
 
 load_dotenv()
 
@@ -17,6 +32,17 @@ OUTPUT_CSV = os.getenv("OUTPUT_CSV") or f"enterprise_teams_users_copilot_{dateti
 # Example: LOGIN_SUFFIX=newgen  -> schander_newgen
 LOGIN_SUFFIX = (os.getenv("LOGIN_SUFFIX") or "").strip().lower()
 
+# Number of teams whose memberships are fetched concurrently
+MAX_WORKERS = int(os.getenv("MAX_WORKERS") or 16)
+
+# Below this many remaining requests in the rate-limit window, requests are paced out
+RATE_LIMIT_THRESHOLD = int(os.getenv("RATE_LIMIT_THRESHOLD") or 100)
+
+# Opt-in: file for ETags and page payloads from the previous run, so unchanged pages come
+# back as 304. It holds full team, membership and Copilot seat payloads (logins, assignee
+# data) as plain JSON, so only set it to a location you are comfortable storing that in.
+ETAG_CACHE_FILE = (os.getenv("ETAG_CACHE_FILE") or "").strip()
+
 if not GITHUB_TOKEN:
     raise SystemExit("Missing GITHUB_TOKEN in environment (.env).")
 if not ENTERPRISE_SLUG:
@@ -34,6 +60,65 @@ HEADERS_SCIM = {
 }
 
 SESSION = requests.Session()
+# One connection per team worker plus one for its page prefetch, so threads never
+# wait on (or discard) pooled connections
+_adapter = HTTPAdapter(pool_maxsize=2 * MAX_WORKERS)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+
+def load_etag_cache(path):
+    if not path:
+        return {}
+    try:
+        with open(path, "rb") as f:
+            cache = _loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_etag_cache(path):
+    if not path:
+        return
+    # Only pages requested this run are kept, so deleted teams drop out of the cache
+    live = {key: ETAG_CACHE[key] for key in ETAG_CACHE_USED if key in ETAG_CACHE}
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(live, f)
+    os.replace(tmp, path)
+
+
+# url -> {"etag": ..., "payload": ..., "next": ...}; loaded by main()
+ETAG_CACHE = {}
+ETAG_CACHE_USED = set()
+
+
+# Pacing sleeps are taken under one lock, so the worker threads share the budget as one client
+_RATE_LIMIT_LOCK = threading.Lock()
+
+
+def pace_rate_limit(resp):
+    """
+    Spread the remaining rate-limit budget over the rest of the window once it runs
+    low, rather than finding out from a 403/429.
+    Returns True if it waited for the window to reset.
+    """
+    remaining = int(resp.headers.get("X-RateLimit-Remaining", RATE_LIMIT_THRESHOLD))
+    reset_time = int(resp.headers.get("X-RateLimit-Reset", 0))
+    if remaining >= RATE_LIMIT_THRESHOLD or not reset_time:
+        return False
+
+    with _RATE_LIMIT_LOCK:
+        # Measured after taking the lock: another thread may already have slept through the reset
+        wait = reset_time - time.time()
+        if remaining == 0:
+            if wait > 0:
+                time.sleep(wait + 1)
+            return True
+        if wait > 0:
+            time.sleep(wait / remaining)
+    return False
 
 
 def gh_get(url, headers, params=None, timeout=60):
@@ -41,11 +126,13 @@ def gh_get(url, headers, params=None, timeout=60):
     for attempt in range(1, 7):
         resp = SESSION.get(url, headers=headers, params=params, timeout=timeout)
         last = resp
+        waited_for_reset = pace_rate_limit(resp)
 
         if resp.status_code in (403, 429, 500, 502, 503, 504):
-            retry_after = resp.headers.get("Retry-After")
-            wait = int(retry_after) if retry_after and retry_after.isdigit() else min(30, 2 * attempt)
-            time.sleep(wait)
+            if not waited_for_reset:
+                retry_after = resp.headers.get("Retry-After")
+                wait = int(retry_after) if retry_after and retry_after.isdigit() else min(30, 2 * attempt)
+                time.sleep(wait)
             continue
 
         return resp
@@ -63,25 +150,56 @@ def normalize_list_payload(payload, keys):
     raise RuntimeError(f"Unsupported list payload shape: {type(payload)}")
 
 
+def gh_get_conditional(url, headers, params=None):
+    """
+    gh_get that revalidates against ETAG_CACHE with If-None-Match.
+    Returns (cache key, response); a 304 response means the cached page is still current.
+    """
+    key = requests.Request("GET", url, params=params).prepare().url
+    ETAG_CACHE_USED.add(key)
+    cached = ETAG_CACHE.get(key)
+    if cached:
+        headers = {**headers, "If-None-Match": cached["etag"]}
+    return key, gh_get(url, headers=headers, params=params)
+
+
 def fetch_rest_list_paged(url, headers, keys, per_page=100, extra_params=None):
     out = []
-    page = 1
-    while True:
-        params = dict(extra_params or {})
-        params["per_page"] = per_page
-        params["page"] = page
-
-        resp = gh_get(url, headers=headers, params=params)
-        if resp.status_code in (403, 404):
-            raise requests.HTTPError(f"{resp.status_code} for {url}: {resp.text}", response=resp)
+    params = dict(extra_params or {})
+    params["per_page"] = per_page
+
+    # Keep the next page's GET in flight while the current page is decoded.
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        pending = prefetch.submit(gh_get_conditional, url, headers, params)
+        while pending is not None:
+            key, resp = pending.result()
+
+            if resp.status_code == 304:
+                cached = ETAG_CACHE[key]
+                next_url = cached["next"]
+            else:
+                if resp.status_code in (403, 404):
+                    raise requests.HTTPError(f"{resp.status_code} for {url}: {resp.text}", response=resp)
+                resp.raise_for_status()
+                next_url = (resp.links.get("next") or {}).get("url")
 
-        resp.raise_for_status()
-        items = normalize_list_payload(resp.json(), keys=keys)
-        out.extend(items)
+            pending = prefetch.submit(gh_get_conditional, next_url, headers) if next_url else None
 
-        if len(items) < per_page:
-            break
-        page += 1
+            if resp.status_code == 304:
+                items = normalize_list_payload(cached["payload"], keys=keys)
+            else:
+                payload = _loads(resp.content)
+                items = normalize_list_payload(payload, keys=keys)
+                etag = resp.headers.get("ETag")
+                # A 304 vouches for the body only, not the Link header: a full last page can
+                # gain a following page without changing, so only pages that have a next page
+                # or are short (any addition changes their body) are safe to revalidate.
+                if ETAG_CACHE_FILE and etag and (next_url or len(items) < per_page):
+                    ETAG_CACHE[key] = {"etag": etag, "payload": payload, "next": next_url}
+                else:
+                    ETAG_CACHE.pop(key, None)
+
+            out.extend(items)
     return out
 
 
@@ -95,23 +213,42 @@ def fetch_all_scim_users():
     count = 100
     users = []
 
-    while True:
-        resp = gh_get(url, headers=HEADERS_SCIM, params={"startIndex": start_index, "count": count})
-        resp.raise_for_status()
+    def get_page(start):
+        return gh_get(url, headers=HEADERS_SCIM, params={"startIndex": start, "count": count})
 
-        payload = resp.json() or {}
-        resources = payload.get("Resources") or []
-        users.extend(resources)
+    # From page 2 on, request the next page before decoding the current one, striding by the
+    # previous page's itemsPerPage (the server may serve fewer than `count`). Page 2 itself is
+    # not overlapped: its start is only known once page 1 has been decoded.
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        resp = get_page(start_index)
+        total_results = None
+        stride = None
 
-        total_results = int(payload.get("totalResults") or 0)
-        items_per_page = int(payload.get("itemsPerPage") or len(resources) or 0)
+        while True:
+            resp.raise_for_status()
 
-        if items_per_page <= 0:
-            break
+            ahead = start_index + stride if stride else None
+            pending = None
+            if ahead is not None and ahead <= total_results:
+                pending = prefetch.submit(get_page, ahead)
 
-        start_index += items_per_page
-        if start_index > total_results:
-            break
+            payload = _loads(resp.content) or {}
+            resources = payload.get("Resources") or []
+            users.extend(resources)
+
+            total_results = int(payload.get("totalResults") or 0)
+            items_per_page = int(payload.get("itemsPerPage") or len(resources) or 0)
+
+            if items_per_page <= 0:
+                break
+
+            start_index += items_per_page
+            if start_index > total_results:
+                break
+
+            # The prefetched page is only usable if this page was the same size as the last one.
+            resp = pending.result() if pending is not None and start_index == ahead else get_page(start_index)
+            stride = items_per_page
 
     return users
 
@@ -153,6 +290,7 @@ def pick_scim_name(u: dict) -> str:
     return ""
 
 
+@lru_cache(maxsize=None)
 def derive_suffix_token() -> str:
     """
     For ENTERPRISE_SLUG like 'Newgen-EMU', default suffix becomes 'newgen'
@@ -164,6 +302,10 @@ def derive_suffix_token() -> str:
     return (ENTERPRISE_SLUG.split("-", 1)[0] or "").strip().lower()
 
 
+_RE_ALNUM_HY = re.compile(r"[^a-z0-9\-]")
+_RE_ALNUM = re.compile(r"[^a-z0-9]")
+
+
 def generate_login_candidates_from_email(email: str) -> set[str]:
     """
     Generate likely GitHub EMU logins from SCIM email.
@@ -182,14 +324,21 @@ def generate_login_candidates_from_email(email: str) -> set[str]:
 
     suffix = derive_suffix_token()
 
+    # Plain [a-z0-9] locals (the common case) have no variants besides themselves
+    if local.isascii() and local.isalnum():
+        out.add(local)
+        if suffix:
+            out.add(f"{local}_{suffix}")
+        return out
+
     # Variants of local-part:
     variants = set()
     variants.add(local)                      # keep as-is
     variants.add(local.replace(".", ""))     # remove dots
     variants.add(local.replace(".", "-"))    # dots to hyphen
     variants.add(local.replace("_", "-"))    # underscores to hyphen
-    variants.add(re.sub(r"[^a-z0-9\-]", "", local))  # keep hyphen, strip others
-    variants.add(re.sub(r"[^a-z0-9]", "", local))    # strict alnum only
+    variants.add(_RE_ALNUM_HY.sub("", local))  # keep hyphen, strip others
+    variants.add(_RE_ALNUM.sub("", local))     # strict alnum only
 
     # Add suffix variants (common EMU: <base>_<suffix>)
     for v in list(variants):
@@ -212,8 +361,12 @@ def build_scim_index(scim_users):
       - email local-part
       - generated EMU login candidates (like schander_newgen)
       - SCIM userName (sometimes equals email)
+
+    Returns (idx, names, emails, scim_user_names): idx maps each key to a row
+    number in the three parallel lists.
     """
     idx = {}
+    names, emails, scim_user_names = [], [], []
     for u in scim_users:
         if not isinstance(u, dict):
             continue
@@ -235,15 +388,18 @@ def build_scim_index(scim_users):
                 keys.add(scim_user_name.split("@", 1)[0].lower())
                 keys |= generate_login_candidates_from_email(scim_user_name)
 
+        keys.discard("")
+        if not keys:
+            continue
+
+        row = len(names)
+        names.append(sys.intern(name))
+        emails.append(sys.intern(email))
+        scim_user_names.append(sys.intern(scim_user_name))
         for k in keys:
-            if not k:
-                continue
-            idx.setdefault(
-                k,
-                {"name": name, "email": email, "scim_userName": scim_user_name},
-            )
+            idx.setdefault(k, row)
 
-    return idx
+    return idx, names, emails, scim_user_names
 
 
 # -------------------------
@@ -252,18 +408,7 @@ def build_scim_index(scim_users):
 def fetch_copilot_billing_seats_by_login():
     url = f"{API_BASE}/enterprises/{ENTERPRISE_SLUG}/copilot/billing/seats"
 
-    all_seats = []
-    page = 1
-    per_page = 100
-    while True:
-        resp = gh_get(url, headers=HEADERS_JSON, params={"per_page": per_page, "page": page})
-        resp.raise_for_status()
-        payload = resp.json() or {}
-        seats = payload.get("seats", []) or []
-        all_seats.extend(seats)
-        if len(seats) < per_page:
-            break
-        page += 1
+    all_seats = fetch_rest_list_paged(url, headers=HEADERS_JSON, keys=("seats",), per_page=100)
 
     by_login = {}
     for s in all_seats:
@@ -273,13 +418,20 @@ def fetch_copilot_billing_seats_by_login():
     return by_login
 
 
+# Reference time for the 30-day activity window, fixed for the whole run
+NOW_UTC = datetime.now(timezone.utc)
+
+
+@lru_cache(maxsize=None)
 def is_active(last_activity_at):
+    """Memoized on the raw timestamp: a seat is classified once however many teams it is in."""
     if not last_activity_at:
         return "inactive"
     try:
         last_activity = datetime.fromisoformat(last_activity_at.replace("Z", "+00:00"))
-        now = datetime.now(last_activity.tzinfo)
-        return "active" if (now - last_activity) <= timedelta(days=30) else "inactive"
+        if last_activity.tzinfo is None:
+            last_activity = last_activity.replace(tzinfo=timezone.utc)
+        return "active" if (NOW_UTC - last_activity) <= timedelta(days=30) else "inactive"
     except Exception:
         return "inactive"
 
@@ -293,6 +445,11 @@ def fetch_enterprise_teams():
 
 
 def fetch_enterprise_team_memberships(team_slug):
+    """
+    Enterprise teams are only exposed through REST (the GraphQL Enterprise object has
+    no teams connection), so memberships are fetched per team; main() runs these calls
+    concurrently instead of batching them into one query.
+    """
     url = f"{API_BASE}/enterprises/{ENTERPRISE_SLUG}/teams/{team_slug}/memberships"
     return fetch_rest_list_paged(url, headers=HEADERS_JSON, keys=("memberships", "items", "data"), per_page=100)
 
@@ -300,6 +457,15 @@ def fetch_enterprise_team_memberships(team_slug):
 def parse_membership_login(m):
     if not isinstance(m, dict):
         return ""
+
+    # Fast path for the usual shapes: {"user": {"login": ...}} or a top-level "login"
+    try:
+        login = m["user"]["login"]
+    except (KeyError, TypeError):
+        login = m.get("login") if "member" not in m else None
+    if isinstance(login, str) and login.strip():
+        return login.strip()
+
     for path in (("user", "login"), ("member", "login"), ("login",)):
         cur = m
         ok = True
@@ -314,69 +480,68 @@ def parse_membership_login(m):
     return ""
 
 
+def map_in_order(pool, fn, args, window):
+    """
+    Like pool.map, but keeps at most `window` calls submitted ahead of the consumer, so a
+    slow early item holds back at most `window` finished results instead of all of them.
+    """
+    args = iter(args)
+    pending = deque(pool.submit(fn, arg) for arg in islice(args, window))
+    while pending:
+        result = pending.popleft().result()
+        pending.extend(pool.submit(fn, arg) for arg in islice(args, 1))
+        yield result
+
+
+def write_rows_from_queue(csv_writer, rows_queue):
+    """
+    Writer-thread loop: writerows every batch put on rows_queue until a None sentinel.
+    After a write error the queue is still drained so the producer never blocks on it;
+    the error is raised once the sentinel arrives.
+    """
+    error = None
+    while True:
+        batch = rows_queue.get()
+        if batch is None:
+            break
+        if error is None:
+            try:
+                csv_writer.writerows(batch)
+            except Exception as e:
+                error = e
+    if error is not None:
+        raise error
+
+
 def main():
     print(f"Enterprise: {ENTERPRISE_SLUG}")
+    ETAG_CACHE.clear()
+    ETAG_CACHE.update(load_etag_cache(ETAG_CACHE_FILE))
+    ETAG_CACHE_USED.clear()
     print(f"Derived login suffix token: {derive_suffix_token()} (override with LOGIN_SUFFIX env if needed)")
 
-    print("Fetching SCIM users...")
-    scim_users = fetch_all_scim_users()
-    scim_index = build_scim_index(scim_users)
-    print(f"SCIM users fetched: {len(scim_users)}; SCIM index keys: {len(scim_index)}")
+    # SCIM users, Copilot seats and teams are independent, so fetch them side by side.
+    print("Fetching SCIM users, Copilot seats and enterprise teams...")
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        scim_future = pool.submit(fetch_all_scim_users)
+        seats_future = pool.submit(fetch_copilot_billing_seats_by_login)
+        teams_future = pool.submit(fetch_enterprise_teams)
 
-    print("Fetching Copilot seats...")
-    seats_by_login = fetch_copilot_billing_seats_by_login()
-    print(f"Copilot seats indexed by login: {len(seats_by_login)}")
+        scim_users = scim_future.result()
+        seats_by_login = seats_future.result()
+        teams = teams_future.result()
 
-    print("Fetching enterprise teams...")
-    teams = fetch_enterprise_teams()
+    scim_index, scim_names, scim_emails, scim_user_names = build_scim_index(scim_users)
+    print(f"SCIM users fetched: {len(scim_users)}; SCIM index keys: {len(scim_index)}")
+    print(f"Copilot seats indexed by login: {len(seats_by_login)}")
     print(f"Enterprise teams fetched: {len(teams)}")
 
-    rows = []
-    no_scim_match = 0
-
-    for i, t in enumerate(teams, start=1):
+    team_refs = []
+    for t in teams:
         team_name = (t.get("name") or t.get("display_name") or t.get("slug") or "").strip()
         team_slug = (t.get("slug") or t.get("team_slug") or "").strip()
-        if not team_slug:
-            continue
-
-        print(f"[{i}/{len(teams)}] Fetching users for team: {team_name} ({team_slug})")
-        memberships = fetch_enterprise_team_memberships(team_slug)
-
-        for m in memberships:
-            login = parse_membership_login(m)
-            if not login:
-                continue
-
-            key = login.lower().strip()
-            scim = scim_index.get(key) or {}
-
-            if not scim:
-                no_scim_match += 1
-
-            seat = seats_by_login.get(login)
-
-            rows.append(
-                {
-                    "enterprise": ENTERPRISE_SLUG,
-                    "team_name": team_name,
-                    "team_slug": team_slug,
-                    "login": login,
-                    "name": scim.get("name", ""),
-                    "email": scim.get("email", ""),
-                    "scim_userName": scim.get("scim_userName", ""),
-                    "copilot_assigned": "yes" if seat else "no",
-                    "copilot_status": (seat or {}).get("status", "") if seat else "",
-                    "plan_type": (seat or {}).get("plan_type", "") if seat else "",
-                    "last_activity_at": (seat or {}).get("last_activity_at", "") if seat else "",
-                    "active_status": is_active((seat or {}).get("last_activity_at")) if seat else "inactive",
-                    "seat_created_at": (seat or {}).get("created_at", "") if seat else "",
-                    "seat_updated_at": (seat or {}).get("updated_at", "") if seat else "",
-                }
-            )
-
-    print(f"Total rows (team-user): {len(rows)}")
-    print(f"Users with no SCIM match (email/name blank): {no_scim_match}")
+        if team_slug:
+            team_refs.append((team_name, team_slug))
 
     fieldnames = [
         "enterprise",
@@ -395,13 +560,78 @@ def main():
         "seat_updated_at",
     ]
 
-    with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        w.writerows(rows)
-
+    total_rows = 0
+    no_scim_match = 0
+    # login -> SCIM row (None when unmatched), shared across teams since users overlap
+    scim_row_by_login = {}
+
+    # Memberships are fetched concurrently (at most 2 * MAX_WORKERS teams ahead) and consumed
+    # in team order. Each team's rows are handed to a writer thread, so CSV formatting and
+    # disk writes overlap the network waits.
+    rows_queue = queue.Queue(maxsize=64)
+    with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=1) as writer_pool:
+        w = csv.writer(f)
+        w.writerow(fieldnames)
+        writer = writer_pool.submit(write_rows_from_queue, w, rows_queue)
+
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+                team_memberships = map_in_order(
+                    pool, fetch_enterprise_team_memberships, [team_slug for _, team_slug in team_refs], 2 * MAX_WORKERS
+                )
+                for i, ((team_name, team_slug), memberships) in enumerate(zip(team_refs, team_memberships), start=1):
+                    print(f"[{i}/{len(team_refs)}] Writing users for team: {team_name} ({team_slug})")
+                    logins = [login for login in map(parse_membership_login, memberships) if login]
+                    for login in set(logins) - scim_row_by_login.keys():
+                        scim_row_by_login[login] = scim_index.get(login.lower())
+
+                    team_rows = []
+                    for login in logins:
+                        scim_row = scim_row_by_login[login]
+
+                        if scim_row is None:
+                            no_scim_match += 1
+                            name = email = scim_user_name = ""
+                        else:
+                            name = scim_names[scim_row]
+                            email = scim_emails[scim_row]
+                            scim_user_name = scim_user_names[scim_row]
+
+                        seat = seats_by_login.get(login)
+
+                        # Columns in fieldnames order
+                        team_rows.append(
+                            (
+                                ENTERPRISE_SLUG,
+                                team_name,
+                                team_slug,
+                                login,
+                                name,
+                                email,
+                                scim_user_name,
+                                "yes" if seat else "no",
+                                seat.get("status", "") if seat else "",
+                                seat.get("plan_type", "") if seat else "",
+                                seat.get("last_activity_at", "") if seat else "",
+                                is_active(seat.get("last_activity_at")) if seat else "inactive",
+                                seat.get("created_at", "") if seat else "",
+                                seat.get("updated_at", "") if seat else "",
+                            )
+                        )
+
+                    rows_queue.put(team_rows)
+                    total_rows += len(team_rows)
+        finally:
+            rows_queue.put(None)
+
+        writer.result()
+
+    print(f"Total rows (team-user): {total_rows}")
+    print(f"Users with no SCIM match (email/name blank): {no_scim_match}")
     print(f"CSV report generated: {OUTPUT_CSV}")
 
+    save_etag_cache(ETAG_CACHE_FILE)
+
 
 if __name__ == "__main__":
 
@@ -1,31 +1,91 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import csv
+import json
 import logging
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+from operator import itemgetter
 from dotenv import load_dotenv
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    _loads = json.loads
+
 load_dotenv()
 
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 ENTERPRISE = os.getenv("ENTERPRISE")
 API_ROOT = "https://api.github.com"
 PER_PAGE = 100
+MAX_WORKERS = int(os.getenv("MAX_WORKERS") or 16)
+# Below this many remaining requests in the rate-limit window, requests are paced out
+RATE_LIMIT_THRESHOLD = int(os.getenv("RATE_LIMIT_THRESHOLD") or 100)
 
 headers = {
     "Authorization": f"token {GITHUB_TOKEN}",
     "Accept": "application/vnd.github+json"
 }
 
+# Shared across worker threads so connections (and TLS sessions) to the API are reused
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=MAX_WORKERS))
+
+# Pacing sleeps are taken under one lock, so the worker threads share the budget as one client
+_RATE_LIMIT_LOCK = threading.Lock()
+
 def handle_rate_limit(response):
-    remaining = int(response.headers.get("X-RateLimit-Remaining", 1))
+    """Pace requests once the budget runs low; returns True if it waited for the window to reset."""
+    remaining = int(response.headers.get("X-RateLimit-Remaining", RATE_LIMIT_THRESHOLD))
     reset_time = int(response.headers.get("X-RateLimit-Reset", 0))
-    if remaining == 0:
-        current_time = int(time.time())
-        sleep_for = max(reset_time - current_time, 1)
-        logging.warning(f"Rate limit reached. Sleeping for {sleep_for} seconds until reset.")
-        time.sleep(sleep_for + 2)
+    if remaining >= RATE_LIMIT_THRESHOLD or not reset_time:
+        return False
+    with _RATE_LIMIT_LOCK:
+        # Measured after taking the lock: another thread may already have slept through the reset
+        sleep_for = reset_time - time.time()
+        if remaining == 0:
+            if sleep_for > 0:
+                logging.warning(f"Rate limit reached. Sleeping for {int(sleep_for)} seconds until reset.")
+                time.sleep(sleep_for + 2)
+            return True
+        if sleep_for > 0:
+            # Running low: spread the remaining budget over the rest of the window
+            time.sleep(sleep_for / remaining)
+    return False
+
+def is_retryable(response):
+    """429s and 5xx are transient; a 403 only when it is a primary or secondary rate limit."""
+    if response.status_code in (429, 500, 502, 503, 504):
+        return True
+    if response.status_code != 403:
+        return False
+    return (
+        response.headers.get("X-RateLimit-Remaining") == "0"
+        or "Retry-After" in response.headers
+        or "secondary rate limit" in response.text.lower()
+    )
+
+def gh_get(url, params=None, timeout=60):
+    last = None
+    for attempt in range(1, 7):
+        response = SESSION.get(url, headers=headers, params=params, timeout=timeout)
+        last = response
+        waited_for_reset = handle_rate_limit(response)
+        if is_retryable(response):
+            if not waited_for_reset:
+                retry_after = response.headers.get("Retry-After")
+                wait = int(retry_after) if retry_after and retry_after.isdigit() else min(30, 2 * attempt)
+                time.sleep(wait)
+            continue
+        return response
+    return last
 
 def fetch_enterprise_teams():
     teams = []
@@ -33,12 +93,11 @@ def fetch_enterprise_teams():
     while True:
         url = f"{API_ROOT}/enterprises/{ENTERPRISE}/teams"
         params = {"per_page": PER_PAGE, "page": page}
-        response = requests.get(url, headers=headers, params=params)
-        handle_rate_limit(response)
+        response = gh_get(url, params=params)
         if response.status_code != 200:
             logging.error(f"Error fetching teams: {response.status_code} - {response.text}")
             break
-        data = response.json()
+        data = _loads(response.content)
         if not data:
             break
         teams.extend(data)
@@ -46,7 +105,6 @@ def fetch_enterprise_teams():
             page += 1
         else:
             break
-        time.sleep(1)
     return teams
 
 def fetch_team_metrics(team_slug):
@@ -55,15 +113,14 @@ def fetch_team_metrics(team_slug):
     while True:
         url = f"{API_ROOT}/enterprises/{ENTERPRISE}/team/{team_slug}/copilot/metrics"
         params = {"per_page": PER_PAGE, "page": page}
-        response = requests.get(url, headers=headers, params=params)
-        handle_rate_limit(response)
+        response = gh_get(url, params=params)
         if response.status_code == 404:
             logging.error(f"Metrics endpoint not found for team {team_slug} (404).")
             break
         if response.status_code != 200:
             logging.error(f"Error fetching metrics for team {team_slug}: {response.status_code} - {response.text}")
             break
-        data = response.json()
+        data = _loads(response.content)
         if not data:
             break
         all_entries.extend(data)
@@ -71,52 +128,78 @@ def fetch_team_metrics(team_slug):
             page += 1
         else:
             break
-        time.sleep(1)
     return all_entries
 
-def write_to_csv(enterprise_id, team_name, entries, csv_writer):
+_EMPTY = {}
+
+# Per-row fields and their defaults when the API omits them
+_LANGUAGE_FIELDS = {
+    "name": "N/A",
+    "total_engaged_users": 0,
+    "total_code_acceptances": 0,
+    "total_code_suggestions": 0,
+    "total_code_lines_accepted": 0,
+    "total_code_lines_suggested": 0,
+}
+_CHAT_MODEL_FIELDS = {
+    "total_chats": 0,
+    "is_custom_model": False,
+    "total_chat_copy_events": 0,
+    "total_chat_insertion_events": 0,
+}
+_get_language_fields = itemgetter(*_LANGUAGE_FIELDS)
+_get_chat_model_fields = itemgetter(*_CHAT_MODEL_FIELDS)
+
+def pick_fields(obj, getter, defaults):
+    try:
+        return getter(obj)
+    except KeyError:
+        return tuple(obj.get(k, d) for k, d in defaults.items())
+
+def iter_metric_rows(enterprise_id, team_name, entries):
     for entry in entries:
         date = entry.get("date", "N/A")
-        copilot_ide_code_completions = entry.get("copilot_ide_code_completions", {})
-        total_active_users = entry.get("total_active_users", 0)
-        total_chat_engaged_users = entry.get("copilot_dotcom_chat", {}).get("total_engaged_users", 0)
-        total_pull_request_engaged_users = entry.get("copilot_dotcom_pull_requests", {}).get("total_engaged_users", 0)
+        totals = (
+            entry.get("total_active_users", 0),
+            (entry.get("copilot_dotcom_chat") or _EMPTY).get("total_engaged_users", 0),
+            (entry.get("copilot_dotcom_pull_requests") or _EMPTY).get("total_engaged_users", 0),
+        )
 
+        copilot_ide_code_completions = entry.get("copilot_ide_code_completions") or _EMPTY
         for editor in copilot_ide_code_completions.get("editors", []):
             editor_name = editor.get("name", "N/A")
             for model in editor.get("models", []):
                 model_name = model.get("name", "N/A")
-                is_custom_model = model.get("is_custom_model", False)
-                total_chats = model.get("total_chats", 0)
                 for language in model.get("languages", []):
-                    language_name = language.get("name", "N/A")
-                    total_engaged_users = language.get("total_engaged_users", 0)
-                    total_code_acceptances = language.get("total_code_acceptances", 0)
-                    total_code_suggestions = language.get("total_code_suggestions", 0)
-                    total_code_lines_accepted = language.get("total_code_lines_accepted", 0)
-                    total_code_lines_suggested = language.get("total_code_lines_suggested", 0)
-
-                    csv_writer.writerow([
-                        enterprise_id, team_name, date, editor_name, model_name, language_name, total_engaged_users,
-                        total_code_acceptances, total_code_suggestions, total_code_lines_accepted,
-                        total_code_lines_suggested, total_active_users, total_chat_engaged_users,
-                        total_pull_request_engaged_users, '', 0, False, 0, 0
-                    ])
-
-        copilot_ide_chat = entry.get("copilot_ide_chat", {})
+                    yield (
+                        enterprise_id, team_name, date, editor_name, model_name,
+                        *pick_fields(language, _get_language_fields, _LANGUAGE_FIELDS),
+                        *totals, '', 0, False, 0, 0
+                    )
+
+        copilot_ide_chat = entry.get("copilot_ide_chat") or _EMPTY
         for chat_editor in copilot_ide_chat.get("editors", []):
             chat_editor_name = chat_editor.get("name", "N/A")
             for model in chat_editor.get("models", []):
-                total_chats = model.get("total_chats", 0)
-                is_custom_model = model.get("is_custom_model", False)
-                total_chat_copy_events = model.get("total_chat_copy_events", 0)
-                total_chat_insertion_events = model.get("total_chat_insertion_events", 0)
+                yield (
+                    enterprise_id, team_name, date, '', '', '', 0, 0, 0, 0, 0, *totals, chat_editor_name,
+                    *pick_fields(model, _get_chat_model_fields, _CHAT_MODEL_FIELDS)
+                )
+
+def write_to_csv(enterprise_id, team_name, entries, csv_writer):
+    csv_writer.writerows(iter_metric_rows(enterprise_id, team_name, entries))
 
-                csv_writer.writerow([
-                    enterprise_id, team_name, date, '', '', '', 0, 0, 0, 0, 0, total_active_users, total_chat_engaged_users,
-                    total_pull_request_engaged_users, chat_editor_name, total_chats, is_custom_model,
-                    total_chat_copy_events, total_chat_insertion_events
-                ])
+def map_in_order(pool, fn, args, window):
+    """
+    Like pool.map, but keeps at most `window` calls submitted ahead of the consumer, so a
+    slow early item holds back at most `window` finished results instead of all of them.
+    """
+    args = iter(args)
+    pending = deque(pool.submit(fn, arg) for arg in islice(args, window))
+    while pending:
+        result = pending.popleft().result()
+        pending.extend(pool.submit(fn, arg) for arg in islice(args, 1))
+        yield result
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -136,13 +219,15 @@ if __name__ == "__main__":
             "total_pull_request_dotcom_engaged_users", "chat_editor_name",
             "total_chats", "is_custom_model", "total_chat_copy_events", "total_chat_insertion_events"
         ])
-        for team in teams:
-            team_name = team.get("name", "N/A")
-            team_slug = team.get("slug")
-            if not team_slug:
-                continue
-            logging.info(f"Fetching metrics for team: {team_name} ({team_slug})")
-            team_metrics = fetch_team_metrics(team_slug)
-            write_to_csv(ENTERPRISE, team_name, team_metrics, writer)
+        team_refs = [(team.get("name", "N/A"), team.get("slug")) for team in teams if team.get("slug")]
+        # Metrics are fetched concurrently (at most 2 * MAX_WORKERS teams ahead) and consumed in
+        # team order; each team's entries are written and released as they come up.
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            team_metrics = map_in_order(
+                pool, fetch_team_metrics, [team_slug for _, team_slug in team_refs], 2 * MAX_WORKERS
+            )
+            for (team_name, team_slug), entries in zip(team_refs, team_metrics):
+                logging.info(f"Writing metrics for team: {team_name} ({team_slug})")
+                write_to_csv(ENTERPRISE, team_name, entries, writer)
 
     logging.info(f"All team data written to {output_file}")
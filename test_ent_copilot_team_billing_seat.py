@@ -0,0 +1,225 @@
+import csv
+import hashlib
+import json
+import os
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("dotenv")
+
+os.environ.setdefault("GITHUB_TOKEN", "test-token")
+os.environ.setdefault("ENTERPRISE_SLUG", "Acme-EMU")
+
+import ent_copilot_team_billing_seat as billing  # noqa: E402
+
+
+class FakeGitHub:
+    """
+    Page-numbered list endpoints with body-derived ETags and Link rel="next" headers,
+    mirroring how the REST API answers conditional requests.
+    """
+
+    def __init__(self, lists):
+        self.lists = lists
+        self.statuses = []
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        parts = urlsplit(url)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        query.update({k: str(v) for k, v in (params or {}).items()})
+        base = f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+        if parts.path.endswith("/Users"):
+            resp = requests.Response()
+            resp.status_code = 200
+            resp._content = json.dumps({"Resources": [], "totalResults": 0, "itemsPerPage": 0}).encode()
+            return resp
+
+        items = self.lists[parts.path]
+        page = int(query.get("page", 1))
+        per_page = int(query.get("per_page", 30))
+        body = json.dumps(items[(page - 1) * per_page:page * per_page]).encode()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+
+        resp = requests.Response()
+        resp.url = url
+        resp.headers["ETag"] = etag
+        if page * per_page < len(items):
+            resp.headers["Link"] = f'<{base}?per_page={per_page}&page={page + 1}>; rel="next"'
+        if (headers or {}).get("If-None-Match") == etag:
+            resp.status_code = 304
+            resp._content = b""
+        else:
+            resp.status_code = 200
+            resp._content = body
+        self.statuses.append(resp.status_code)
+        return resp
+
+
+TEAMS_PATH = "/enterprises/Acme-EMU/teams"
+SEATS_PATH = "/enterprises/Acme-EMU/copilot/billing/seats"
+MEMBERS_PATH = "/enterprises/Acme-EMU/teams/core/memberships"
+OLD_MEMBERS_PATH = "/enterprises/Acme-EMU/teams/old/memberships"
+MEMBERS_URL = f"https://api.github.com{MEMBERS_PATH}"
+
+
+def members(n):
+    return [{"login": f"user{i}_acme"} for i in range(n)]
+
+
+@pytest.fixture
+def cache_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "etag_cache.json")
+    monkeypatch.setattr(billing, "ETAG_CACHE_FILE", path)
+    monkeypatch.setattr(billing, "ETAG_CACHE", {})
+    monkeypatch.setattr(billing, "ETAG_CACHE_USED", set())
+    return path
+
+
+def new_run(monkeypatch, path):
+    """Reload the persisted cache the way a fresh process would."""
+    monkeypatch.setattr(billing, "ETAG_CACHE", billing.load_etag_cache(path))
+    monkeypatch.setattr(billing, "ETAG_CACHE_USED", set())
+
+
+def fetch_members():
+    return billing.fetch_rest_list_paged(MEMBERS_URL, headers={}, keys=("memberships",), per_page=100)
+
+
+def test_unchanged_pages_are_served_from_cache(cache_file, monkeypatch):
+    api = FakeGitHub({MEMBERS_PATH: members(150)})
+    monkeypatch.setattr(billing, "SESSION", api)
+
+    first = fetch_members()
+    billing.save_etag_cache(cache_file)
+    new_run(monkeypatch, cache_file)
+    api.statuses.clear()
+
+    assert fetch_members() == first
+    assert api.statuses == [304, 304]
+
+
+def test_full_last_page_picks_up_new_page(cache_file, monkeypatch):
+    api = FakeGitHub({MEMBERS_PATH: members(100)})
+    monkeypatch.setattr(billing, "SESSION", api)
+
+    assert len(fetch_members()) == 100
+    billing.save_etag_cache(cache_file)
+    new_run(monkeypatch, cache_file)
+
+    api.lists[MEMBERS_PATH] = members(101)
+    assert len(fetch_members()) == 101
+
+
+def test_nothing_is_cached_when_disabled(monkeypatch):
+    monkeypatch.setattr(billing, "ETAG_CACHE_FILE", "")
+    monkeypatch.setattr(billing, "ETAG_CACHE", {})
+    monkeypatch.setattr(billing, "SESSION", FakeGitHub({MEMBERS_PATH: members(150)}))
+
+    assert len(fetch_members()) == 150
+    assert billing.ETAG_CACHE == {}
+
+
+class ScriptedSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        return self.responses.pop(0)
+
+
+def rate_limited_response(status, remaining, reset_time):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = b"[]"
+    resp.headers["X-RateLimit-Remaining"] = str(remaining)
+    resp.headers["X-RateLimit-Reset"] = str(reset_time)
+    resp.headers["Retry-After"] = "60"
+    return resp
+
+
+def test_rate_limited_403_waits_for_reset_once(monkeypatch):
+    now = 1_000_000
+    sleeps = []
+    monkeypatch.setattr(billing.time, "time", lambda: now)
+    monkeypatch.setattr(billing.time, "sleep", sleeps.append)
+    monkeypatch.setattr(billing, "SESSION", ScriptedSession([
+        rate_limited_response(403, 0, now + 10),
+        rate_limited_response(200, 5000, now + 3600),
+    ]))
+
+    assert billing.gh_get(MEMBERS_URL, headers={}).status_code == 200
+    assert sleeps == [11]
+
+
+def report_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return len(list(csv.reader(f))) - 1
+
+
+def test_rerun_reports_grown_team_and_prunes_removed_team(cache_file, tmp_path, monkeypatch):
+    output = tmp_path / "report.csv"
+    monkeypatch.setattr(billing, "OUTPUT_CSV", str(output))
+    api = FakeGitHub({
+        TEAMS_PATH: [{"name": "Core", "slug": "core"}, {"name": "Old", "slug": "old"}],
+        SEATS_PATH: [],
+        MEMBERS_PATH: members(100),
+        OLD_MEMBERS_PATH: members(3),
+    })
+    monkeypatch.setattr(billing, "SESSION", api)
+
+    billing.main()
+    assert report_rows(output) == 103
+
+    # main() reloads the cache from disk, as a fresh process would
+    billing.ETAG_CACHE.clear()
+    api.lists[TEAMS_PATH] = [{"name": "Core", "slug": "core"}]
+    api.lists[MEMBERS_PATH] = members(101)
+    api.statuses.clear()
+    billing.main()
+
+    assert report_rows(output) == 101
+    assert 304 in api.statuses  # the unchanged first members page was revalidated
+    assert not any(OLD_MEMBERS_PATH in key for key in billing.load_etag_cache(cache_file))
+
+
+def test_map_in_order_bounds_submissions_ahead_of_consumer():
+    from concurrent.futures import Future
+
+    submitted = []
+
+    class RecordingPool:
+        def submit(self, fn, arg):
+            submitted.append(arg)
+            fut = Future()
+            fut.set_result(fn(arg))
+            return fut
+
+    results = []
+    for result in billing.map_in_order(RecordingPool(), lambda x: x * 10, range(10), 3):
+        # Calls still pending, not counting the result in hand
+        assert len(submitted) - len(results) - 1 <= 3
+        results.append(result)
+    assert results == [x * 10 for x in range(10)]
+
+
+def test_scim_prefetch_follows_server_page_size(monkeypatch):
+    users = [{"userName": f"user{i}@acme.com"} for i in range(300)]
+    starts = []
+
+    class ScimAPI:
+        def get(self, url, headers=None, params=None, timeout=None):
+            start = params["startIndex"]
+            starts.append(start)
+            page = users[start - 1:start - 1 + 50]  # server caps pages at 50, below the requested count
+            resp = requests.Response()
+            resp.status_code = 200
+            resp._content = json.dumps({"Resources": page, "totalResults": len(users), "itemsPerPage": len(page)}).encode()
+            return resp
+
+    monkeypatch.setattr(billing, "SESSION", ScimAPI())
+
+    assert billing.fetch_all_scim_users() == users
+    assert sorted(starts) == [1, 51, 101, 151, 201, 251]
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("dotenv")
+
+os.environ.setdefault("GITHUB_TOKEN", "test-token")
+os.environ.setdefault("ENTERPRISE", "acme")
+
+import fetch_ent_team_copilot_metrics as metrics  # noqa: E402
+
+
+class ScriptedSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def response(status, body=b"[]", **headers):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body
+    resp.headers.update(headers)
+    return resp
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(metrics.time, "sleep", recorded.append)
+    return recorded
+
+
+def test_permanent_403_is_not_retried(monkeypatch, sleeps):
+    session = ScriptedSession([
+        response(403, b'{"message": "Copilot Metrics API access is disabled"}', **{"X-RateLimit-Remaining": "4000"}),
+    ])
+    monkeypatch.setattr(metrics, "SESSION", session)
+
+    assert metrics.fetch_team_metrics("core") == []
+    assert session.calls == 1
+    assert sleeps == []
+
+
+def test_secondary_rate_limit_403_is_retried(monkeypatch, sleeps):
+    session = ScriptedSession([
+        response(403, b'{"message": "You have exceeded a secondary rate limit."}', **{"X-RateLimit-Remaining": "4000"}),
+        response(200, b'[{"date": "2024-06-01"}]', **{"X-RateLimit-Remaining": "4000"}),
+    ])
+    monkeypatch.setattr(metrics, "SESSION", session)
+
+    assert metrics.fetch_team_metrics("core") == [{"date": "2024-06-01"}]
+    assert session.calls == 2
+    assert sleeps == [2]